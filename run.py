@@ -1,24 +1,34 @@
-from elasticsearch import Elasticsearch
-from json import dumps, loads
-from logging import info, warning, error, basicConfig, INFO
+from aio_pika import DeliveryMode, Message, connect_robust
+from aio_pika.abc import AbstractIncomingMessage
+from asyncio import Lock, Queue, Semaphore, TimeoutError, create_task, get_running_loop, run, sleep, wait_for
+from collections import OrderedDict
+from elasticsearch import ApiError, AsyncElasticsearch, BadRequestError, TransportError
+from elasticsearch.helpers import BulkIndexError
+from itertools import islice
+from logging import info, warning, error, basicConfig, INFO, StreamHandler
+from orjson import dumps, loads
 from os import getenv, _exit
-from pika import BlockingConnection, ConnectionParameters, PlainCredentials
+from pythonjsonlogger.orjson import OrjsonFormatter
 from requests import get
 from sys import exit
-from time import sleep
+from time import monotonic
+from uuid import uuid4
 
 
-basicConfig(format=dumps({
-    'datetime': '%(asctime)s',
-    'loglevel': '[%(levelname)s]',
-    'message': '%(message)s'
-}), datefmt='%H:%M:%S %d/%m/%Y', level=INFO)
+log_handler = StreamHandler()
+log_handler.setFormatter(OrjsonFormatter(
+    '%(asctime)s %(levelname)s %(message)s',
+    datefmt='%H:%M:%S %d/%m/%Y',
+    rename_fields={'asctime': 'datetime', 'levelname': 'loglevel'}
+))
+basicConfig(level=INFO, handlers=[log_handler])
 
 ELASTICSEARCH_HOST         = getenv(key='ELASTICSEARCH_HOST')
 ELASTICSEARCH_PORT         = getenv(key='ELASTICSEARCH_PORT')
 ELASTICSEARCH_USERNAME     = getenv(key='ELASTICSEARCH_USERNAME')
 ELASTICSEARCH_PW           = getenv(key='ELASTICSEARCH_PW')
 ELASTICSEARCH_MAX_RESULT   = getenv(key='ELASTICSEARCH_MAX_RESULT')
+ELASTICSEARCH_REPLICAS     = getenv(key='ELASTICSEARCH_REPLICAS', default='1')
 
 RABBITMQ_HOST              = getenv(key='RABBITMQ_HOST')
 RABBITMQ_MANAGEMENT_PORT   = getenv(key='RABBITMQ_MANAGEMENT_PORT')
@@ -27,16 +37,38 @@ RABBITMQ_QUEUE_NAME_LISTEN = getenv(key='RABBITMQ_QUEUE_NAME_LISTEN')
 RABBITMQ_QUEUE_NAME_ANSWER = getenv(key='RABBITMQ_QUEUE_NAME_ANSWER')
 RABBITMQ_USERNAME          = getenv(key='RABBITMQ_USERNAME')
 RABBITMQ_PASSWORD          = getenv(key='RABBITMQ_PW')
+RABBITMQ_PREFETCH          = getenv(key='RABBITMQ_PREFETCH', default='64')
 
+DEDUP_CACHE_SIZE           = 4096
+DEDUP_CACHE_TTL            = 60.0
 
-def main():
-    elasticsearch_response = connect_elasticsearch()
-    if check_env() is False or elasticsearch_response is False or check_rabbitmq() is False:
+ANSWER_PROPERTIES          = {
+    'delivery_mode': DeliveryMode.NOT_PERSISTENT,
+    'content_type': 'application/json'
+}
+
+RABBITMQ_RETRY_DELAY       = 5000
+
+BULK_QUEUE_SIZE            = 10000
+BULK_MAX_ACTIONS           = 50
+BULK_MAX_TIME              = 0.1
+BULK_MAX_RETRIES           = 3
+
+dedup_cache = OrderedDict()
+write_queue = Queue(maxsize=BULK_QUEUE_SIZE)
+
+
+async def main():
+    if check_env() is False:
         return
-    processor(elasticsearch_response=elasticsearch_response)
+    elasticsearch_response = await connect_elasticsearch()
+    if elasticsearch_response is False or check_rabbitmq() is False:
+        return
+    await processor(elasticsearch_response=elasticsearch_response)
 
 
 def check_env():
+    global ELASTICSEARCH_MAX_RESULT, ELASTICSEARCH_REPLICAS, RABBITMQ_PREFETCH
     info(msg='Checking environment variables...')
     env_vars = {
         'ELASTICSEARCH_HOST': ELASTICSEARCH_HOST,
@@ -44,6 +76,7 @@ def check_env():
         'ELASTICSEARCH_USERNAME': ELASTICSEARCH_USERNAME,
         'ELASTICSEARCH_PW': ELASTICSEARCH_PW,
         'ELASTICSEARCH_MAX_RESULT': ELASTICSEARCH_MAX_RESULT,
+        'ELASTICSEARCH_REPLICAS': ELASTICSEARCH_REPLICAS,
         'RABBITMQ_HOST': RABBITMQ_HOST,
         'RABBITMQ_MANAGEMENT_PORT': RABBITMQ_MANAGEMENT_PORT,
         'RABBITMQ_OPERATION_PORT': RABBITMQ_OPERATION_PORT,
@@ -51,43 +84,113 @@ def check_env():
         'RABBITMQ_QUEUE_NAME_ANSWER': RABBITMQ_QUEUE_NAME_ANSWER,
         'RABBITMQ_USERNAME': RABBITMQ_USERNAME,
         'RABBITMQ_PW': RABBITMQ_PASSWORD,
+        'RABBITMQ_PREFETCH': RABBITMQ_PREFETCH,
     }
-    if not all([value for _, value in env_vars.items()]):
-        error(msg=f'Missing required variables: {[key for key, value in env_vars.items() if not value]}')
+    missing = [key for key, value in env_vars.items() if not value]
+    if missing:
+        error(msg=f'Missing required variables: {missing}')
+        return False
+    try:
+        ELASTICSEARCH_MAX_RESULT = int(ELASTICSEARCH_MAX_RESULT)
+    except ValueError:
+        error(msg=f'ELASTICSEARCH_MAX_RESULT must be an integer, got "{ELASTICSEARCH_MAX_RESULT}"')
+        return False
+    try:
+        ELASTICSEARCH_REPLICAS = int(ELASTICSEARCH_REPLICAS)
+    except ValueError:
+        error(msg=f'ELASTICSEARCH_REPLICAS must be an integer, got "{ELASTICSEARCH_REPLICAS}"')
+        return False
+    if ELASTICSEARCH_REPLICAS < 0:
+        error(msg=f'ELASTICSEARCH_REPLICAS must be at least 0, got "{ELASTICSEARCH_REPLICAS}"')
+        return False
+    try:
+        RABBITMQ_PREFETCH = int(RABBITMQ_PREFETCH)
+    except ValueError:
+        error(msg=f'RABBITMQ_PREFETCH must be an integer, got "{RABBITMQ_PREFETCH}"')
+        return False
+    if RABBITMQ_PREFETCH < 1:
+        error(msg=f'RABBITMQ_PREFETCH must be at least 1, got "{RABBITMQ_PREFETCH}"')
         return False
     info(msg='Environment variables [OK]')
     return True
 
 
-def connect_elasticsearch():
+async def connect_elasticsearch():
     info(msg='Checking Elasticsearch...')
     try:
-        elasticsearch_response = Elasticsearch(
+        elasticsearch_response = AsyncElasticsearch(
             hosts=f'http://{ELASTICSEARCH_HOST}:{ELASTICSEARCH_PORT}', 
-            basic_auth=(ELASTICSEARCH_USERNAME, ELASTICSEARCH_PW)
+            basic_auth=(ELASTICSEARCH_USERNAME, ELASTICSEARCH_PW),
+            node_class='aiohttp',
+            connections_per_node=RABBITMQ_PREFETCH,
+            http_compress=False,
+            request_timeout=5,
+            retry_on_timeout=True,
+            max_retries=2,
+            sniff_on_start=False
         )
     except ValueError as error_exception:
         error(msg=str(error_exception))
         return False
-    while True:
-        if elasticsearch_response.ping() is False:
-            warning(msg='Ping to Elasticsearch fail, re-ping after 5 seconds')
-            sleep(5)
-        else:
-            break
+    delay = 0.1
+    while await elasticsearch_response.ping() is False:
+        warning(msg=f'Ping to Elasticsearch fail, re-ping after {delay} seconds')
+        await sleep(delay)
+        delay = min(delay * 2, 5)
     info(msg='Elasticsearch [OK]')
     index_settings = {
         "settings": {
             "index": {
-                "max_result_window": int(ELASTICSEARCH_MAX_RESULT)
+                "max_result_window": ELASTICSEARCH_MAX_RESULT,
+                "codec": "best_compression",
+                "refresh_interval": "5s",
+                "translog": {
+                    "durability": "async",
+                    "sync_interval": "5s"
+                },
+                "number_of_shards": 1,
+                "number_of_replicas": ELASTICSEARCH_REPLICAS
+            }
+        },
+        "mappings": {
+            "properties": {
+                "detail_ip": {"type": "ip"},
+                "detail_hashed_rule": {"type": "keyword", "ignore_above": 128},
+                "detail_hashed_payload": {"type": "keyword", "ignore_above": 128},
+                "responser_name": {"type": "keyword"},
+                "type": {"type": "keyword"},
+                "status": {"type": "keyword"},
+                "for": {"type": "keyword"}
             }
         }
     }
     info(msg='Checking "responser-modsecurity-executions" index...')
-    if not elasticsearch_response.indices.exists(index='responser-modsecurity-executions'):
+    if not await elasticsearch_response.indices.exists(index='responser-modsecurity-executions'):
         info(msg='Creating "responser-modsecurity-executions"')
-        elasticsearch_response.indices.create(index="responser-modsecurity-executions", body=index_settings)
+        await elasticsearch_response.indices.create(index="responser-modsecurity-executions", body=index_settings)
         info(msg='Created "responser-modsecurity-executions"')
+    else:
+        try:
+            await elasticsearch_response.indices.put_mapping(
+                index='responser-modsecurity-executions',
+                body=index_settings['mappings']
+            )
+        except BadRequestError as error_exception:
+            warning(msg=f'Can\'t apply mappings to "responser-modsecurity-executions", reindex is required: {error_exception}')
+        try:
+            await elasticsearch_response.indices.put_settings(
+                index='responser-modsecurity-executions',
+                settings={
+                    "index": {
+                        "refresh_interval": index_settings["settings"]["index"]["refresh_interval"],
+                        "translog": {
+                            "durability": index_settings["settings"]["index"]["translog"]["durability"]
+                        }
+                    }
+                }
+            )
+        except BadRequestError as error_exception:
+            warning(msg=f'Can\'t apply settings to "responser-modsecurity-executions": {error_exception}')
     info(msg='"responser-modsecurity-executions" [OK]')
     return elasticsearch_response
 
@@ -109,265 +212,248 @@ def check_rabbitmq():
     return True
 
 
-def processor(elasticsearch_response: Elasticsearch):
-    connection = BlockingConnection(
-        ConnectionParameters(
-            host=RABBITMQ_HOST,
-            port=RABBITMQ_OPERATION_PORT,
-            credentials=PlainCredentials(
-                username=RABBITMQ_USERNAME,
-                password=RABBITMQ_PASSWORD
-            )
-        )
+async def processor(elasticsearch_response: AsyncElasticsearch):
+    connection = await connect_robust(
+        host=RABBITMQ_HOST,
+        port=int(RABBITMQ_OPERATION_PORT),
+        login=RABBITMQ_USERNAME,
+        password=RABBITMQ_PASSWORD
     )
-    channel = connection.channel()
-    channel.queue_declare(queue=RABBITMQ_QUEUE_NAME_LISTEN, durable=True)
-    channel.queue_declare(queue=RABBITMQ_QUEUE_NAME_ANSWER, durable=True)
-    def callback(ch, method, properties, body: bytes):
-        request_body: dict = loads(body.decode())
-        responser_name = request_body.get('responser_name')
-        modsec_type = request_body.get('type')
-        details: dict = request_body.get('details')
-        detail_ip = details.get('ip')
-        detail_ip_source = None
-        if detail_ip is not None:
-            detail_ip_source = detail_ip.get('source_ip')
-        detail_hashed_rule = details.get('hashed_rule')
-        detail_hashed_payload = details.get('hashed_payload')
-        payload = request_body.get('payload')
-        modsecurity_executions = elasticsearch_response.search(index='responser-modsecurity-executions', query={'match_all': {}}, size=ELASTICSEARCH_MAX_RESULT).raw['hits']['hits']
-        if modsec_type == 'full':
-            if [
-                entity for entity in modsecurity_executions
-                if entity['_source']['detail_ip'] == detail_ip_source
-                and entity['_source']['detail_hashed_rule'] == detail_hashed_rule
-                and entity['_source']['detail_hashed_payload'] == detail_hashed_payload
-            ].__len__() > 0:
-                process_double_secrule(
-                    elasticsearch_response=elasticsearch_response,
-                    responser_name=responser_name,
-                    modsec_type=modsec_type,
-                    detail_ip=detail_ip_source,
-                    detail_hashed_rule=detail_hashed_rule,
-                    detail_hashed_payload=detail_hashed_payload,
-                    status='duplicated',
-                    payload=payload
-                )
-            else:
-                modsecurity_execution = process_double_secrule(
+    async with connection:
+        channel = await connection.channel()
+        prefetch_count = RABBITMQ_PREFETCH
+        answer_queue = RABBITMQ_QUEUE_NAME_ANSWER
+        await channel.set_qos(prefetch_count=prefetch_count)
+        retry_queue = f'{RABBITMQ_QUEUE_NAME_LISTEN}-retry'
+        queue = await channel.declare_queue(name=RABBITMQ_QUEUE_NAME_LISTEN, durable=True)
+        await channel.declare_queue(name=answer_queue, durable=True)
+        await channel.declare_queue(name=retry_queue, durable=True, arguments={
+            'x-message-ttl': RABBITMQ_RETRY_DELAY,
+            'x-dead-letter-exchange': '',
+            'x-dead-letter-routing-key': RABBITMQ_QUEUE_NAME_LISTEN
+        })
+        publish = channel.default_exchange.publish
+        message_loads = loads
+        semaphore = Semaphore(prefetch_count)
+        dedup_locks = {}
+        tasks = set()
+        async def on_message(message: AbstractIncomingMessage):
+            async with semaphore:
+                try:
+                    await callback(body=message.body)
+                except Exception as error_exception:
+                    if is_retryable(error_exception=error_exception):
+                        warning(msg=f'Can\'t process message "{message.delivery_tag}", retry after {RABBITMQ_RETRY_DELAY} ms: {error_exception}')
+                        await publish(
+                            Message(
+                                body=message.body,
+                                headers=message.headers,
+                                content_type=message.content_type,
+                                delivery_mode=DeliveryMode.PERSISTENT
+                            ),
+                            routing_key=retry_queue
+                        )
+                        await message.ack()
+                    else:
+                        error(msg=f'Can\'t process message "{message.delivery_tag}", dropped: {error_exception}')
+                        await message.reject(requeue=False)
+                    return
+                await message.ack()
+        async def callback(body: bytes):
+            request_body: dict = message_loads(body)
+            responser_name = request_body.get('responser_name')
+            modsec_type = request_body.get('type')
+            details: dict = request_body.get('details')
+            detail_ip_source = (details.get('ip') or {}).get('source_ip')
+            detail_hashed_rule = details.get('hashed_rule')
+            detail_hashed_payload = details.get('hashed_payload')
+            payload = request_body.get('payload')
+            dispatch = DISPATCH.get(modsec_type)
+            if dispatch is None:
+                return
+            handler, fields, kind = dispatch
+            detail_ip_source = detail_ip_source if 'ip' in fields else None
+            detail_hashed_rule = detail_hashed_rule if 'rule' in fields else None
+            detail_hashed_payload = detail_hashed_payload if 'payload' in fields else None
+            dedup_key = (modsec_type, detail_ip_source, detail_hashed_rule, detail_hashed_payload)
+            dedup_lock = dedup_locks.setdefault(dedup_key, Lock())
+            try:
+                async with dedup_lock:
+                    duplicated = dedup_cache_get(key=dedup_key)
+                    if duplicated is None:
+                        duplicated = await duplicate_exists(
+                            elasticsearch_response=elasticsearch_response,
+                            detail_ip=detail_ip_source,
+                            detail_hashed_rule=detail_hashed_rule,
+                            detail_hashed_payload=detail_hashed_payload
+                        )
+                    dedup_cache_set(key=dedup_key, duplicated=True)
+            finally:
+                if dedup_locks.get(dedup_key) is dedup_lock and not dedup_lock.locked():
+                    del dedup_locks[dedup_key]
+            try:
+                modsecurity_execution = await handler(
                     elasticsearch_response=elasticsearch_response,
                     responser_name=responser_name,
                     modsec_type=modsec_type,
                     detail_ip=detail_ip_source,
                     detail_hashed_rule=detail_hashed_rule,
                     detail_hashed_payload=detail_hashed_payload,
-                    status='waiting',
+                    status='duplicated' if duplicated else 'waiting',
                     payload=payload
                 )
-                request_body['execution_id'] = None
-                request_body['execution_id_for_ip'] = modsecurity_execution[0]
-                request_body['execution_id_for_chain'] = modsecurity_execution[1]
-                channel.basic_publish(exchange='', routing_key=RABBITMQ_QUEUE_NAME_ANSWER, body=dumps(request_body))
-        if modsec_type == 'onlyRegexAndPayload':
-            if [
-                entity for entity in modsecurity_executions
-                if entity['_source']['detail_ip'] is None
-                and entity['_source']['detail_hashed_rule'] == detail_hashed_rule
-                and entity['_source']['detail_hashed_payload'] == detail_hashed_payload
-            ].__len__() > 0:
-                process_single_secrule(
-                    elasticsearch_response=elasticsearch_response,
-                    responser_name=responser_name,
-                    modsec_type=modsec_type,
-                    detail_ip=None,
-                    detail_hashed_rule=detail_hashed_rule,
-                    detail_hashed_payload=detail_hashed_payload,
-                    status='duplicated',
-                    payload=payload
-                )
-            else:
-                modsecurity_execution = process_single_secrule(
-                    elasticsearch_response=elasticsearch_response,
-                    responser_name=responser_name,
-                    modsec_type=modsec_type,
-                    detail_ip=None,
-                    detail_hashed_rule=detail_hashed_rule,
-                    detail_hashed_payload=detail_hashed_payload,
-                    status='waiting',
-                    payload=payload
-                )
-                request_body['execution_id'] = modsecurity_execution[0]
-                request_body['execution_id_for_ip'] = None
-                request_body['execution_id_for_chain'] = None
-                channel.basic_publish(exchange='', routing_key=RABBITMQ_QUEUE_NAME_ANSWER, body=dumps(request_body))
-        if modsec_type == 'onlyPayload':
-            if [
-                entity for entity in modsecurity_executions
-                if entity['_source']['detail_ip'] is None
-                and entity['_source']['detail_hashed_rule'] is None
-                and entity['_source']['detail_hashed_payload'] == detail_hashed_payload
-            ].__len__() > 0:
-                process_single_secrule(
-                    elasticsearch_response=elasticsearch_response,
-                    responser_name=responser_name,
-                    modsec_type=modsec_type,
-                    detail_ip=None,
-                    detail_hashed_rule=None,
-                    detail_hashed_payload=detail_hashed_payload,
-                    status='duplicated',
-                    payload=payload
-                )
-            else:
-                modsecurity_execution = process_single_secrule(
-                    elasticsearch_response=elasticsearch_response,
-                    responser_name=responser_name,
-                    modsec_type=modsec_type,
-                    detail_ip=None,
-                    detail_hashed_rule=None,
-                    detail_hashed_payload=detail_hashed_payload,
-                    status='waiting',
-                    payload=payload
-                )
-                request_body['execution_id'] = modsecurity_execution[0]
-                request_body['execution_id_for_ip'] = None
-                request_body['execution_id_for_chain'] = None
-                channel.basic_publish(exchange='', routing_key=RABBITMQ_QUEUE_NAME_ANSWER, body=dumps(request_body))
-        if modsec_type == 'onlyIP':
-            if [
-                entity for entity in modsecurity_executions
-                if entity['_source']['detail_ip'] == detail_ip_source
-                and entity['_source']['detail_hashed_rule'] is None
-                and entity['_source']['detail_hashed_payload'] is None
-            ].__len__() > 0:
-                process_single_secrule(
-                    elasticsearch_response=elasticsearch_response,
-                    responser_name=responser_name,
-                    modsec_type=modsec_type,
-                    detail_ip=detail_ip_source,
-                    detail_hashed_rule=None,
-                    detail_hashed_payload=None,
-                    status='duplicated',
-                    payload=payload
-                )
-            else:
-                modsecurity_execution = process_single_secrule(
-                    elasticsearch_response=elasticsearch_response,
-                    responser_name=responser_name,
-                    modsec_type=modsec_type,
-                    detail_ip=detail_ip_source,
-                    detail_hashed_rule=None,
-                    detail_hashed_payload=None,
-                    status='waiting',
-                    payload=payload
+            except Exception:
+                if not duplicated:
+                    dedup_cache.pop(dedup_key, None)
+                raise
+            if not duplicated:
+                if kind == 'double':
+                    execution_ids = {
+                        'execution_id': None,
+                        'execution_id_for_ip': modsecurity_execution[0],
+                        'execution_id_for_chain': modsecurity_execution[1]
+                    }
+                else:
+                    execution_ids = {
+                        'execution_id': modsecurity_execution[0],
+                        'execution_id_for_ip': None,
+                        'execution_id_for_chain': None
+                    }
+                await publish(
+                    Message(
+                        body=answer_body(body=body, request_body=request_body, execution_ids=execution_ids),
+                        **ANSWER_PROPERTIES
+                    ),
+                    routing_key=answer_queue
                 )
-                request_body['execution_id'] = modsecurity_execution[0]
-                request_body['execution_id_for_ip'] = None
-                request_body['execution_id_for_chain'] = None
-                channel.basic_publish(exchange='', routing_key=RABBITMQ_QUEUE_NAME_ANSWER, body=dumps(request_body))
-        if modsec_type == 'onlyIPAndPayload':
-            if [
-                entity for entity in modsecurity_executions
-                if entity['_source']['detail_ip'] == detail_ip_source
-                and entity['_source']['detail_hashed_rule'] is None
-                and entity['_source']['detail_hashed_payload'] == detail_hashed_payload
-            ].__len__() > 0:
-                process_double_secrule(
-                    elasticsearch_response=elasticsearch_response,
-                    responser_name=responser_name,
-                    modsec_type=modsec_type,
-                    detail_ip=detail_ip_source,
-                    detail_hashed_rule=None,
-                    detail_hashed_payload=detail_hashed_payload,
-                    status='duplicated',
-                    payload=payload
-                )
-            else:
-                modsecurity_execution = process_double_secrule(
-                    elasticsearch_response=elasticsearch_response,
-                    responser_name=responser_name,
-                    modsec_type=modsec_type,
-                    detail_ip=detail_ip_source,
-                    detail_hashed_rule=None,
-                    detail_hashed_payload=detail_hashed_payload,
-                    status='waiting',
-                    payload=payload
-                )
-                request_body['execution_id'] = None
-                request_body['execution_id_for_ip'] = modsecurity_execution[0]
-                request_body['execution_id_for_chain'] = modsecurity_execution[1]
-                channel.basic_publish(exchange='', routing_key=RABBITMQ_QUEUE_NAME_ANSWER, body=dumps(request_body))
-        if modsec_type == 'onlyIPAndRegex':
-            if [
-                entity for entity in modsecurity_executions
-                if entity['_source']['detail_ip'] == detail_ip_source
-                and entity['_source']['detail_hashed_rule'] == detail_hashed_rule
-                and entity['_source']['detail_hashed_payload'] is None
-            ].__len__() > 0:
-                process_double_secrule(
-                    elasticsearch_response=elasticsearch_response,
-                    responser_name=responser_name,
-                    modsec_type=modsec_type,
-                    detail_ip=detail_ip_source,
-                    detail_hashed_rule=detail_hashed_rule,
-                    detail_hashed_payload=None,
-                    status='duplicated',
-                    payload=payload
-                )
-            else:
-                modsecurity_execution = process_double_secrule(
-                    elasticsearch_response=elasticsearch_response,
-                    responser_name=responser_name,
-                    modsec_type=modsec_type,
-                    detail_ip=detail_ip_source,
-                    detail_hashed_rule=detail_hashed_rule,
-                    detail_hashed_payload=None,
-                    status='waiting',
-                    payload=payload
-                )
-                request_body['execution_id'] = None
-                request_body['execution_id_for_ip'] = modsecurity_execution[0]
-                request_body['execution_id_for_chain'] = modsecurity_execution[1]
-                channel.basic_publish(exchange='', routing_key=RABBITMQ_QUEUE_NAME_ANSWER, body=dumps(request_body))
-        if modsec_type == 'onlyRegex':
-            if [
-                entity for entity in modsecurity_executions
-                if entity['_source']['detail_ip'] is None
-                and entity['_source']['detail_hashed_rule'] == detail_hashed_rule
-                and entity['_source']['detail_hashed_payload'] is None
-            ].__len__() > 0:
-                process_single_secrule(
-                    elasticsearch_response=elasticsearch_response,
-                    responser_name=responser_name,
-                    modsec_type=modsec_type,
-                    detail_ip=None,
-                    detail_hashed_rule=detail_hashed_rule,
-                    detail_hashed_payload=None,
-                    status='duplicated',
-                    payload=payload
+        async def consumer(message: AbstractIncomingMessage):
+            task = create_task(on_message(message=message))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        writer = create_task(bulk_writer(elasticsearch_response=elasticsearch_response))
+        await queue.consume(consumer, no_ack=False)
+        await writer
+
+
+def answer_body(body: bytes, request_body: dict, execution_ids: dict):
+    if request_body.keys().isdisjoint(execution_ids):
+        return body.rstrip()[:-1] + b',' + dumps(execution_ids)[1:]
+    return dumps({**request_body, **execution_ids})
+
+
+def retryable_status(status: int):
+    return status == 429 or status >= 500
+
+
+def is_retryable(error_exception: Exception):
+    if isinstance(error_exception, BulkIndexError):
+        return all(retryable_status(status=failure['status']) for failure in error_exception.errors)
+    if isinstance(error_exception, ApiError):
+        return retryable_status(status=error_exception.status_code)
+    return isinstance(error_exception, TransportError)
+
+
+def dedup_cache_get(key: tuple):
+    cached = dedup_cache.get(key)
+    if cached is None:
+        return None
+    duplicated, cached_at = cached
+    if monotonic() - cached_at >= DEDUP_CACHE_TTL:
+        del dedup_cache[key]
+        return None
+    dedup_cache.move_to_end(key)
+    return duplicated
+
+
+def dedup_cache_set(key: tuple, duplicated: bool):
+    dedup_cache[key] = (duplicated, monotonic())
+    dedup_cache.move_to_end(key)
+    if len(dedup_cache) > DEDUP_CACHE_SIZE:
+        dedup_cache.popitem(last=False)
+
+
+async def bulk_writer(elasticsearch_response: AsyncElasticsearch):
+    loop = get_running_loop()
+    while True:
+        operations, future = await write_queue.get()
+        executions = [(operations, future, None)]
+        actions = len(operations) // 2
+        deadline = loop.time() + BULK_MAX_TIME
+        while actions < BULK_MAX_ACTIONS:
+            try:
+                operations, future = await wait_for(write_queue.get(), timeout=max(deadline - loop.time(), 0))
+            except TimeoutError:
+                break
+            executions.append((operations, future, None))
+            actions += len(operations) // 2
+        for attempt in range(BULK_MAX_RETRIES):
+            retries = []
+            try:
+                modsecurity_executions = await elasticsearch_response.bulk(
+                    operations=[operation for operations, _, _ in executions for operation in operations],
+                    refresh=False
                 )
+            except Exception as error_exception:
+                warning(msg=f'Bulk indexing of {len(executions)} executions fail: {error_exception}')
+                retries = [(operations, future, error_exception) for operations, future, _ in executions]
             else:
-                modsecurity_execution = process_single_secrule(
-                    elasticsearch_response=elasticsearch_response,
-                    responser_name=responser_name,
-                    modsec_type=modsec_type,
-                    detail_ip=None,
-                    detail_hashed_rule=detail_hashed_rule,
-                    detail_hashed_payload=None,
-                    status='waiting',
-                    payload=payload
-                )
-                request_body['execution_id'] = modsecurity_execution[0]
-                request_body['execution_id_for_ip'] = None
-                request_body['execution_id_for_chain'] = None
-                channel.basic_publish(exchange='', routing_key=RABBITMQ_QUEUE_NAME_ANSWER, body=dumps(request_body))
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-    channel.basic_qos(prefetch_count=1)
-    channel.basic_consume(queue=RABBITMQ_QUEUE_NAME_LISTEN, on_message_callback=callback)
-    channel.start_consuming()
-
-
-def process_single_secrule(
-    elasticsearch_response: Elasticsearch,
+                items = iter(modsecurity_executions['items'])
+                for operations, future, _ in executions:
+                    failures = [
+                        item['index'] for item in islice(items, len(operations) // 2)
+                        if 'error' in item['index']
+                    ]
+                    if not failures:
+                        if not future.done():
+                            future.set_result(None)
+                        continue
+                    error_exception = BulkIndexError(f'{len(failures)} document(s) failed to index', failures)
+                    if all(retryable_status(status=failure['status']) for failure in failures):
+                        retries.append((operations, future, error_exception))
+                    elif not future.done():
+                        future.set_exception(error_exception)
+            executions = retries
+            if not executions:
+                break
+            if attempt < BULK_MAX_RETRIES - 1:
+                await sleep(BULK_MAX_TIME * 2 ** attempt)
+        for _, future, error_exception in executions:
+            if not future.done():
+                future.set_exception(error_exception)
+
+
+async def write_executions(operations: list):
+    future = get_running_loop().create_future()
+    await write_queue.put((operations, future))
+    await future
+
+
+async def duplicate_exists(
+    elasticsearch_response: AsyncElasticsearch,
+    detail_ip: str,
+    detail_hashed_rule: str,
+    detail_hashed_payload: str
+):
+    predicates = []
+    for field, value in (
+        ('detail_ip', detail_ip),
+        ('detail_hashed_rule', detail_hashed_rule),
+        ('detail_hashed_payload', detail_hashed_payload)
+    ):
+        if value is None:
+            predicates.append({'bool': {'must_not': {'exists': {'field': field}}}})
+        else:
+            predicates.append({'term': {field: value}})
+    modsecurity_executions = await elasticsearch_response.count(
+        index='responser-modsecurity-executions',
+        body={'query': {'bool': {'filter': predicates}}},
+        terminate_after=1
+    )
+    return modsecurity_executions['count'] > 0
+
+
+async def process_single_secrule(
+    elasticsearch_response: AsyncElasticsearch,
     responser_name: str,
     modsec_type: str,
     detail_ip: str,
@@ -376,31 +462,35 @@ def process_single_secrule(
     status: str,
     payload: str
 ):
-    modsecurity_execution = elasticsearch_response.index(index='responser-modsecurity-executions', document={
-        'responser_name': responser_name,
-        'secrule_id': None,
-        'type': modsec_type,
-        'for': None,
-        'start': None,
-        'detail_ip': detail_ip,
-        'anomaly_score': None,
-        'paranoia_level': None,
-        'detail_rule': None,
-        'detail_payload': None,
-        'detail_hashed_rule': detail_hashed_rule,
-        'detail_hashed_payload': detail_hashed_payload,
-        'payload': dumps(payload),
-        'relationship': None,
-        'real_id_relationship': None,
-        'status': status
-    }, refresh='wait_for')
+    modsecurity_execution_id = uuid4().hex
+    await write_executions(operations=[
+        {'index': {'_index': 'responser-modsecurity-executions', '_id': modsecurity_execution_id}},
+        {
+            'responser_name': responser_name,
+            'secrule_id': None,
+            'type': modsec_type,
+            'for': None,
+            'start': None,
+            'detail_ip': detail_ip,
+            'anomaly_score': None,
+            'paranoia_level': None,
+            'detail_rule': None,
+            'detail_payload': None,
+            'detail_hashed_rule': detail_hashed_rule,
+            'detail_hashed_payload': detail_hashed_payload,
+            'payload': dumps(payload).decode(),
+            'relationship': None,
+            'real_id_relationship': None,
+            'status': status
+        }
+    ])
     return (
-        modsecurity_execution['_id'],
+        modsecurity_execution_id,
     )
 
 
-def process_double_secrule(
-    elasticsearch_response: Elasticsearch,
+async def process_double_secrule(
+    elasticsearch_response: AsyncElasticsearch,
     responser_name: str,
     modsec_type: str,
     detail_ip: str,
@@ -409,59 +499,69 @@ def process_double_secrule(
     status: str,
     payload: str
 ):
-    modsecurity_execution_for_ip = elasticsearch_response.index(index='responser-modsecurity-executions', document={
-        'responser_name': responser_name,
-        'secrule_id': None,
-        'type': modsec_type,
-        'for': 'ip',
-        'start': None,
-        'detail_ip': detail_ip,
-        'anomaly_score': None,
-        'paranoia_level': None,
-        'detail_rule': None,
-        'detail_payload': None,
-        'detail_hashed_rule': detail_hashed_rule,
-        'detail_hashed_payload': detail_hashed_payload,
-        'payload': dumps(payload),
-        'relationship': None,
-        'real_id_relationship': None,
-        'status': status
-    }, refresh='wait_for')
-    modsecurity_execution_for_chain = elasticsearch_response.index(index='responser-modsecurity-executions', document={
-        'responser_name': responser_name,
-        'secrule_id': None,
-        'type': modsec_type,
-        'for': 'chain',
-        'start': None,
-        'detail_ip': detail_ip,
-        'anomaly_score': None,
-        'paranoia_level': None,
-        'detail_rule': None,
-        'detail_payload': None,
-        'detail_hashed_rule': detail_hashed_rule,
-        'detail_hashed_payload': detail_hashed_payload,
-        'payload': dumps(payload),
-        'relationship': None,
-        'real_id_relationship': modsecurity_execution_for_ip['_id'],
-        'status': status
-    }, refresh='wait_for')
-    elasticsearch_response.update(
-        index='responser-modsecurity-executions',
-        id=modsecurity_execution_for_ip['_id'],
-        doc={
-            'real_id_relationship': modsecurity_execution_for_chain['_id']
+    payload_json = dumps(payload).decode()
+    modsecurity_execution_for_ip_id = uuid4().hex
+    modsecurity_execution_for_chain_id = uuid4().hex
+    await write_executions(operations=[
+        {'index': {'_index': 'responser-modsecurity-executions', '_id': modsecurity_execution_for_ip_id}},
+        {
+            'responser_name': responser_name,
+            'secrule_id': None,
+            'type': modsec_type,
+            'for': 'ip',
+            'start': None,
+            'detail_ip': detail_ip,
+            'anomaly_score': None,
+            'paranoia_level': None,
+            'detail_rule': None,
+            'detail_payload': None,
+            'detail_hashed_rule': detail_hashed_rule,
+            'detail_hashed_payload': detail_hashed_payload,
+            'payload': payload_json,
+            'relationship': None,
+            'real_id_relationship': modsecurity_execution_for_chain_id,
+            'status': status
         },
-        refresh='wait_for'
-    )
+        {'index': {'_index': 'responser-modsecurity-executions', '_id': modsecurity_execution_for_chain_id}},
+        {
+            'responser_name': responser_name,
+            'secrule_id': None,
+            'type': modsec_type,
+            'for': 'chain',
+            'start': None,
+            'detail_ip': detail_ip,
+            'anomaly_score': None,
+            'paranoia_level': None,
+            'detail_rule': None,
+            'detail_payload': None,
+            'detail_hashed_rule': detail_hashed_rule,
+            'detail_hashed_payload': detail_hashed_payload,
+            'payload': payload_json,
+            'relationship': None,
+            'real_id_relationship': modsecurity_execution_for_ip_id,
+            'status': status
+        }
+    ])
     return (
-        modsecurity_execution_for_ip['_id'],
-        modsecurity_execution_for_chain['_id']
+        modsecurity_execution_for_ip_id,
+        modsecurity_execution_for_chain_id
     )
 
 
+DISPATCH = {
+    'full': (process_double_secrule, ('ip', 'rule', 'payload'), 'double'),
+    'onlyRegexAndPayload': (process_single_secrule, ('rule', 'payload'), 'single'),
+    'onlyPayload': (process_single_secrule, ('payload',), 'single'),
+    'onlyIP': (process_single_secrule, ('ip',), 'single'),
+    'onlyIPAndPayload': (process_double_secrule, ('ip', 'payload'), 'double'),
+    'onlyIPAndRegex': (process_double_secrule, ('ip', 'rule'), 'double'),
+    'onlyRegex': (process_single_secrule, ('rule',), 'single')
+}
+
+
 if __name__ == '__main__':
     try:
-        main()
+        run(main())
     except KeyboardInterrupt:
         try:
             exit(0)